@@ -1,180 +1,511 @@
 # --- Imports ---
 import os
-import json
+import orjson
+import sys
+import queue
+import logging
+import logging.handlers
 import argparse
+import numpy as np
 import pandas as pd
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from azure.ai.formrecognizer import DocumentAnalysisClient
+import random
+import asyncio
+import hashlib
+import functools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from urllib.parse import urlparse
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 
 # --- Configuration & Constants ---
+log = logging.getLogger(__name__)
 # Load credentials from environment variables for security.
 AZURE_ENDPOINT = os.environ.get("AZURE_ENDPOINT")
 AZURE_KEY = os.environ.get("AZURE_KEY")
 MAX_RETRIES = 3 # Max number of retries for a failed API call.
+BACKOFF_BASE = 1.0 # Seconds; lower bound of the jittered backoff between retries.
+MAX_BACKOFF = 30.0 # Seconds; upper cap on any single backoff sleep.
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504} # Throttling and transient server errors.
+# Max number of documents in flight against Azure at once, and max new analyze requests per second.
+# Raise both to match your pricing tier's quota.
+# Invalid values (not a number, or below 1) are stored as None and rejected at startup.
+def _positive_env(name: str, default: str, cast):
+    try:
+        value = cast(os.environ.get(name, default))
+    except ValueError:
+        return None
+    return value if value >= 1 else None
 
-def analyze_document(image_path: str) -> tuple:
+AZURE_MAX_CONCURRENCY = _positive_env("AZURE_MAX_CONCURRENCY", "20", int)
+AZURE_MAX_TPS = _positive_env("AZURE_MAX_TPS", "15", float)
+CACHE_DIR = ".cache" # On-disk cache of Azure results, keyed by file content and model.
+CACHE_FORMAT = "raw-v1" # Mixed into cache keys; bump when the cached JSON layout changes.
+FINGERPRINT_BYTES = 64 * 1024 # Leading bytes hashed to spot duplicate files before any API call.
+POLLING_INTERVAL = 1.0 # Seconds between status checks while Azure analyzes a document.
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg') # File types picked up when scanning a directory.
+URL_PREFIXES = ('http://', 'https://') # Inputs Azure can fetch itself (e.g. blob storage URLs).
+# Heuristics: line items that look like discounts, and header lines that are never the vendor name.
+DISCOUNT_PATTERN = r"discount|coupon|saving" # Matched case-insensitively against item descriptions.
+JUNK_WORDS = frozenset({"RECEIPT", "INVOICE", "BILL", "TAX INVOICE", "CASH MEMO", "THANK YOU"})
+# Raw JSON key holding the parsed value for each Azure field type.
+FIELD_VALUE_KEYS = {
+    "string": "valueString", "date": "valueDate", "time": "valueTime", "phoneNumber": "valuePhoneNumber",
+    "number": "valueNumber", "integer": "valueInteger", "currency": "valueCurrency",
+    "countryRegion": "valueCountryRegion", "boolean": "valueBoolean",
+    "array": "valueArray", "object": "valueObject",
+}
+# Fixed column order of the summary CSV.
+CSV_COLUMNS = [
+    "vendor_name", "date", "time", "subtotal", "tax", "tip", "discount", "total",
+    "source_file", "calculated_total", "validation_passed",
+]
+
+# --- Data Records ---
+class ItemColumns:
+    """
+    A receipt's line items stored column-wise: three parallel lists instead of one
+    dict per item. Rows are only materialized when the JSON log is written.
+    """
+    __slots__ = ("description", "quantity", "price")
+
+    def __init__(self):
+        self.description, self.quantity, self.price = [], [], []
+
+    def append(self, description: str | None, quantity: float, price: float):
+        self.description.append(description)
+        self.quantity.append(quantity)
+        self.price.append(price)
+
+    def rows(self) -> list:
+        return [{"description": d, "quantity": q, "price": p}
+                for d, q, p in zip(self.description, self.quantity, self.price)]
+
+@dataclass(slots=True)
+class ValidationInfo:
+    """Result of checking that subtotal, discount, tax and tip add up to the total."""
+    calculated_total: float
+    validation_passed: bool
+
+@dataclass(slots=True)
+class Receipt:
+    """Structured data extracted from one receipt. Field order matches the JSON/CSV output."""
+    items: ItemColumns = field(default_factory=ItemColumns)
+    vendor_name: str | None = None
+    date: str | None = None
+    time: str | None = None
+    subtotal: float | None = None
+    tax: float | None = None
+    tip: float | None = None
+    discount: float | None = None
+    total: float | None = None
+    validation_info: ValidationInfo | None = None
+    source_file: str | None = None
+    # True once a document was extracted. The leading underscore keeps it out of the
+    # JSON log (orjson skips such fields); read it through `is_empty`.
+    _parsed: bool = field(default=False, repr=False)
+
+    @property
+    def is_empty(self) -> bool:
+        """True when Azure returned no document, so there is nothing to discount or validate."""
+        return not self._parsed
+
+_VALIDATION_COLUMNS = frozenset(ValidationInfo.__dataclass_fields__) # CSV columns taken from validation_info.
+
+class RateLimiter:
+    """
+    Spaces out request submissions so at most `rate` start per second, keeping
+    bursts under the Azure transactions-per-second quota instead of hitting 429s.
+    """
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate
+        self._next_slot = 0.0
+
+    async def acquire(self):
+        # Single event loop: no await between reading and reserving the slot, so no lock is needed.
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+def _build_client() -> DocumentAnalysisClient:
+    """
+    Builds the async Azure client. One client is shared by every in-flight request,
+    so its pooled HTTP connections, TLS sessions and credential are reused.
+    """
+    return DocumentAnalysisClient(endpoint=AZURE_ENDPOINT, credential=AzureKeyCredential(AZURE_KEY))
+
+def _is_url(path: str) -> bool:
+    return path.lower().startswith(URL_PREFIXES)
+
+def _display_name(image_path: str) -> str:
+    """File name for logs and output; drops the query string (e.g. SAS tokens) from URLs."""
+    return os.path.basename(urlparse(image_path).path if _is_url(image_path) else image_path)
+
+def _cache_key(data: bytes, model_id: str) -> str:
+    """Hashes the file content together with the model id, so model changes miss the cache."""
+    digest = hashlib.blake2b(f"{model_id}:{CACHE_FORMAT}".encode(), digest_size=16)
+    digest.update(data)
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=256)
+def _load_cached_result(key: str) -> dict:
+    """
+    Loads a cached Azure result. Raises OSError on a miss and orjson.JSONDecodeError on a
+    damaged entry; callers treat both as a miss (exceptions are not memoized).
+    """
+    with open(os.path.join(CACHE_DIR, f"{key}.json"), 'rb') as f:
+        return orjson.loads(f.read())
+
+def _save_cached_result(key: str, result: dict):
+    """Persists an Azure result so identical files are never sent (and billed) twice."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write to a temp file and rename it into place, so an interrupted write never
+    # leaves a partial entry behind.
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps(result))
+        os.replace(tmp_path, os.path.join(CACHE_DIR, f"{key}.json"))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def _raw_analyze_result(pipeline_response, _, headers) -> dict:
+    """
+    LRO callback that returns the raw `analyzeResult` JSON instead of letting the SDK
+    build an object per field, word and line; only a handful of fields are ever read.
+    """
+    return orjson.loads(pipeline_response.http_response.body())["analyzeResult"]
+
+async def analyze_document(client: DocumentAnalysisClient, image_path: str, rate_limiter: RateLimiter = None) -> tuple:
     """
     Analyzes a single document image using the Azure 'prebuilt-receipt' model.
-    Implements a retry mechanism with exponential backoff for resilience.
+    Remote URLs are handed to Azure to fetch directly, with no local read.
+    Local results are cached on disk by content hash, so repeat files skip the API call.
+    Implements a retry mechanism with jittered exponential backoff for resilience.
+    Client errors (bad request, auth, not found) are not retried.
 
     Args:
-        image_path: The local path to the image file.
+        client: The shared async Azure client.
+        image_path: The local path or http(s) URL of the image file.
+        rate_limiter: Optional limiter awaited before every submission (including retries).
 
     Returns:
-        A tuple containing the Azure result object and the original filename.
+        A tuple containing the raw `analyzeResult` JSON (as a dict) and the original filename.
     """
     model_id = "prebuilt-receipt"
-    if not os.path.exists(image_path):
-        print(f"SKIPPING: Image not found at path: {image_path}")
-        return None, os.path.basename(image_path)
+    name = _display_name(image_path)
+    is_url = _is_url(image_path)
+    cache_key = None
+    if not is_url:
+        # Read once: the same bytes feed both the cache key and the upload. The caller has
+        # already found the file, so a missing/unreadable one is only reported, not pre-checked.
+        try:
+            with open(image_path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            log.warning("SKIPPING: Could not read image at path: %s (%s)", image_path, e)
+            return None, name
+        cache_key = _cache_key(data, model_id)
+        try:
+            result = _load_cached_result(cache_key)
+            log.info("\n- Using cached result for '%s'.", name)
+            return result, name
+        except (OSError, orjson.JSONDecodeError):
+            pass # Missing or damaged entry: analyze again and overwrite it.
     
-    print(f"\n- Submitting '{os.path.basename(image_path)}' for analysis...")
+    log.info("\n- Submitting '%s' for analysis...", name)
     
-    # Retry loop to handle transient network errors.
+    # Retry loop to handle transient network errors and throttling.
     for attempt in range(MAX_RETRIES):
         try:
-            document_analysis_client = DocumentAnalysisClient(
-                endpoint=AZURE_ENDPOINT, credential=AzureKeyCredential(AZURE_KEY)
-            )
-            with open(image_path, "rb") as f:
-                poller = document_analysis_client.begin_analyze_document(model_id, document=f)
-            result = poller.result()
-            return result, os.path.basename(image_path)
+            if rate_limiter:
+                await rate_limiter.acquire()
+            if is_url:
+                # Azure fetches the document itself, so nothing is read or uploaded locally.
+                poller = await client.begin_analyze_document_from_url(
+                    model_id, image_path, polling_interval=POLLING_INTERVAL, cls=_raw_analyze_result
+                )
+            else:
+                poller = await client.begin_analyze_document(
+                    model_id, document=data, polling_interval=POLLING_INTERVAL, cls=_raw_analyze_result
+                )
+            result = await poller.result()
+            break
         except Exception as e:
-            print(f"  - Attempt {attempt + 1} failed for '{os.path.basename(image_path)}': {e}")
+            log.warning("  - Attempt %d failed for '%s': %s", attempt + 1, name, e)
+            if isinstance(e, HttpResponseError) and e.status_code not in RETRYABLE_STATUS_CODES:
+                log.error("  - Unrecoverable error for '%s', not retrying.", name)
+                return None, name
             if attempt < MAX_RETRIES - 1:
-                time.sleep(2 ** attempt) # Exponential backoff: 1s, 2s
+                # Jittered exponential backoff so concurrent workers don't retry in lockstep.
+                await asyncio.sleep(min(MAX_BACKOFF, random.uniform(BACKOFF_BASE, BACKOFF_BASE * 3 * (2 ** attempt))))
             else:
-                print(f"  - All retries failed for '{os.path.basename(image_path)}'.")
-                return None, os.path.basename(image_path)
+                log.error("  - All retries failed for '%s'.", name)
+                return None, name
+
+    # Cache outside the retry loop: a failed write must never resend (and re-bill) the file.
+    if cache_key:
+        try:
+            _save_cached_result(cache_key, result)
+        except OSError as e:
+            log.warning("  - Could not cache result for '%s': %s", name, e)
+    return result, name
+
+def _field_value(fields: dict, name: str, default=None):
+    """Returns the value of a raw Azure document field, or `default` if it is missing."""
+    f = fields.get(name)
+    if not f:
+        return default
+    field_type = f.get("type")
+    value = f.get(FIELD_VALUE_KEYS.get(field_type))
+    if field_type == "currency" and value is not None:
+        value = value.get("amount")
+    if value is None:
+        return default
+    # Amounts are always floats, matching what the SDK objects used to return.
+    return float(value) if field_type in ("number", "integer", "currency") else value
 
-def extract_and_validate_receipt(result) -> dict:
+def extract_and_validate_receipt(result: dict) -> Receipt:
     """
-    Parses the raw Azure result object into a clean, validated dictionary.
-    Includes logic for item extraction, discount hunting, and total validation.
+    Parses the raw Azure `analyzeResult` JSON into a clean Receipt record.
+    Includes logic for item extraction; discounts and total validation are
+    computed afterwards for the whole batch by `apply_discounts` and `validate_totals`.
 
     Args:
-        result: The result object from the Azure `analyze_document` call.
+        result: The raw `analyzeResult` dict returned by `analyze_document`.
 
     Returns:
-        A dictionary containing the structured and validated receipt data.
+        A Receipt containing the structured receipt data.
     """
-    if not result or not result.documents:
-        return {}
+    if not result or not result.get("documents"):
+        return Receipt()
 
-    doc = result.documents[0]
-    final_result = {"items": []}
-    
-    def get_field(field_name):
-        """Helper to safely get a field's value and confidence."""
-        field = doc.fields.get(field_name)
-        return (field.value, field.confidence) if field else (None, 0.0)
+    fields = result["documents"][0].get("fields", {})
+    content = result.get("content")
 
     # --- Field Extraction ---
-    vendor_name, vendor_conf = get_field("VendorName")
+    vendor_name = _field_value(fields, "VendorName")
     
     # Heuristic: If AI fails, guess the vendor name from the top lines of text.
-    if not vendor_name and result.content:
-        print("  -> AI did not find VendorName. Applying fallback heuristic...")
-        JUNK_WORDS = ["RECEIPT", "INVOICE", "BILL", "TAX INVOICE", "CASH MEMO", "THANK YOU"]
-        possible_lines = [line.strip() for line in result.content.split('\n') if line.strip()][:5]
+    if not vendor_name and content:
+        log.info("  -> AI did not find VendorName. Applying fallback heuristic...")
+        possible_lines = [line.strip() for line in content.split('\n') if line.strip()][:5]
         for line in possible_lines:
             if line.upper() not in JUNK_WORDS and len(line) > 2:
-                vendor_name, vendor_conf = line, "Heuristic-Guess"
+                vendor_name = line
                 break
     
-    date_val, date_conf = get_field("TransactionDate")
-    time_val, time_conf = get_field("TransactionTime")
-    subtotal, subtotal_conf = get_field("Subtotal")
-    tax, tax_conf = get_field("TotalTax")
-    tip, tip_conf = get_field("Tip")
-    total, total_conf = get_field("Total")
+    date_val = _field_value(fields, "TransactionDate")
+    time_val = _field_value(fields, "TransactionTime")
+    subtotal = _field_value(fields, "Subtotal")
+    tax = _field_value(fields, "TotalTax")
+    tip = _field_value(fields, "Tip")
+    total = _field_value(fields, "Total")
     
     # --- Item & Discount Extraction ---
-    discount = 0.0
-    items_field = doc.fields.get("Items")
-    if items_field and items_field.value:
-        for item in items_field.value:
-            desc_f = item.value.get("Description")
-            price_f = item.value.get("TotalPrice")
-            qty_f = item.value.get("Quantity")
-            
-            desc = desc_f.value if desc_f else None
-            price = price_f.value if price_f else 0.0
-            qty = qty_f.value if qty_f else 1.0
-            
-            final_result["items"].append({"description": desc, "quantity": qty, "price": price})
-            
-            # Heuristic for finding discounts within the line items.
-            if desc and any(k in desc.lower() for k in ["discount", "coupon", "saving"]) or price < 0:
-                discount += abs(price)
-
-    # --- Mathematical Validation ---
-    subtotal_val = subtotal or 0.0
-    tax_val = tax or 0.0
-    tip_val = tip or 0.0
-    total_val = total or 0.0
-    
-    calculated_total = subtotal_val - discount + tax_val + tip_val
-    validation_passed = abs(calculated_total - total_val) < 0.01 # Tolerance for float comparison
-
+    items = ItemColumns()
+    items_value = _field_value(fields, "Items")
+    if items_value:
+        for item in items_value:
+            item_fields = item.get("valueObject") or {}
+            items.append(
+                _field_value(item_fields, "Description"),
+                _field_value(item_fields, "Quantity", 1.0),
+                _field_value(item_fields, "TotalPrice", 0.0),
+            )
     # --- Assemble Final Output ---
-    final_result.update({
-        "vendor_name": vendor_name,
-        "date": str(date_val) if date_val else None,
-        "time": str(time_val) if time_val else None,
-        "subtotal": subtotal,
-        "tax": tax,
-        "tip": tip,
-        "discount": discount,
-        "total": total,
-        "validation_info": {
-            "calculated_total": round(calculated_total, 2),
-            "validation_passed": validation_passed
-        }
+    return Receipt(
+        items=items,
+        vendor_name=vendor_name,
+        date=str(date_val) if date_val else None,
+        time=str(time_val) if time_val else None,
+        subtotal=subtotal,
+        tax=tax,
+        tip=tip,
+        discount=0.0, # Updated for the whole batch by apply_discounts.
+        _parsed=True,
+        total=total,
+    )
+
+def apply_discounts(receipts: list):
+    """
+    Heuristic for finding discounts within the line items: an item counts if its description
+    looks like a discount or its price is negative. All items of all receipts go into one
+    DataFrame, so the description match runs as a single vectorized pass, and each receipt's
+    discount is set to the sum of its matching items' absolute prices.
+    Empty receipts (no document extracted) are skipped.
+    """
+    parsed = [r for r in receipts if not r.is_empty]
+    counts = [len(r.items.price) for r in parsed]
+    if not sum(counts): return
+
+    items_df = pd.DataFrame({
+        "receipt_id": np.repeat(np.arange(len(parsed)), counts),
+        "description": [d for r in parsed for d in r.items.description],
+        "price": np.fromiter((p for r in parsed for p in r.items.price), dtype=np.float64, count=sum(counts)),
     })
-    return final_result
+    mask = (items_df["description"].str.contains(DISCOUNT_PATTERN, case=False, regex=True, na=False)
+            | (items_df["price"] < 0))
+    discounts = (items_df["price"].abs().where(mask, 0.0)
+                 .groupby(items_df["receipt_id"]).sum()
+                 .reindex(range(len(parsed)), fill_value=0.0))
+
+    for receipt, discount in zip(parsed, discounts.tolist()):
+        receipt.discount = discount
 
-def process_receipt_path_concurrently(path: str) -> list:
+def validate_totals(receipts: list):
+    """
+    Checks that subtotal - discount + tax + tip matches the total for every receipt
+    in one vectorized NumPy pass, and fills in each receipt's validation_info.
+    Empty receipts (no document extracted) are left without validation info.
+    """
+    parsed = [r for r in receipts if not r.is_empty]
+    if not parsed: return
+
+    amounts = np.array(
+        [(r.subtotal or 0.0, r.discount, r.tax or 0.0, r.tip or 0.0, r.total or 0.0) for r in parsed],
+        dtype=np.float64,
+    )
+    subtotal, discount, tax, tip, total = amounts.T
+    calculated_total = subtotal - discount + tax + tip
+    validation_passed = np.abs(calculated_total - total) < 0.01 # Tolerance for float comparison
+
+    for receipt, calc, passed in zip(parsed, calculated_total.tolist(), validation_passed.tolist()):
+        receipt.validation_info = ValidationInfo(calculated_total=round(calc, 2), validation_passed=passed)
+
+def _fingerprint(image_path: str) -> tuple:
+    """Cheap duplicate check: file size plus a hash of the first FINGERPRINT_BYTES."""
+    try:
+        with open(image_path, "rb") as f:
+            head = f.read(FINGERPRINT_BYTES)
+            size = os.fstat(f.fileno()).st_size
+    except OSError:
+        return None, image_path # Unique, so analyze_document reports the unreadable file itself.
+    return size, hashlib.blake2b(head, digest_size=8).digest()
+
+def _full_digest(image_path: str):
+    """Full-content hash confirming a fingerprint match; unreadable files get a unique key."""
+    try:
+        with open(image_path, "rb") as f:
+            return hashlib.blake2b(f.read(), digest_size=16).digest()
+    except OSError:
+        return image_path # Unique, so analyze_document reports the unreadable file itself.
+
+def _group_duplicates(image_paths: list) -> dict:
+    """
+    Groups byte-identical files so each is sent to Azure only once.
+    Fingerprints are computed in a small thread pool; files larger than the fingerprinted
+    prefix that still collide are confirmed with a full-content hash in the same pool.
+
+    Returns:
+        A dict mapping each path to analyze to the list of its duplicates (in input order).
+    """
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        by_fingerprint = {}
+        for img_path, fp in zip(image_paths, pool.map(_fingerprint, image_paths)):
+            by_fingerprint.setdefault(fp, []).append(img_path)
+
+        # Same size and prefix is not proof for larger files; hash those collisions in full.
+        to_confirm = [img_path for (size, _), paths in by_fingerprint.items()
+                      if len(paths) > 1 and size > FINGERPRINT_BYTES for img_path in paths]
+        digests = dict(zip(to_confirm, pool.map(_full_digest, to_confirm)))
+
+    groups = {}
+    for paths in by_fingerprint.values():
+        if paths[0] in digests:
+            by_digest = {}
+            for img_path in paths:
+                by_digest.setdefault(digests[img_path], []).append(img_path)
+            candidates = by_digest.values()
+        else:
+            candidates = [paths]
+        for first, *duplicates in candidates:
+            groups[first] = duplicates
+    return groups
+
+async def process_receipt_path_concurrently(path: str) -> list:
     """
     Manages the processing of a single file or a directory of files concurrently.
 
     Args:
-        path: A path to an image file or a directory.
+        path: A path to an image file or a directory, or an http(s) URL of an image.
 
     Returns:
-        A list of dictionaries, where each dictionary is the extracted data from one receipt.
+        A list of Receipt records, one per successfully analyzed receipt.
     """
     all_results = []
     
-    if os.path.isdir(path):
-        image_paths = [os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    if _is_url(path):
+        image_paths = [path]
+    elif os.path.isdir(path):
+        # scandir entries carry their file type, so no extra stat call is needed per file.
+        with os.scandir(path) as entries:
+            image_paths = [e.path for e in entries
+                           if e.is_file(follow_symlinks=False) and e.name.lower().endswith(IMAGE_EXTENSIONS)]
     elif os.path.isfile(path):
         image_paths = [path]
     else:
-        print(f"ERROR: Path does not exist or is not a file/directory: {path}")
+        log.error("ERROR: Path does not exist or is not a file/directory: %s", path)
         return []
     
     if not image_paths:
-        print(f"No images found in path: {path}")
+        log.warning("No images found in path: %s", path)
         return []
 
-    print(f"Found {len(image_paths)} image(s). Processing concurrently...")
+    log.info("Found %d image(s). Processing concurrently...", len(image_paths))
+
+    # Identical local files are analyzed once and the result is copied to each duplicate.
+    if len(image_paths) > 1:
+        duplicates = _group_duplicates(image_paths)
+        if len(duplicates) < len(image_paths):
+            log.info("Skipping %d duplicate image(s).", len(image_paths) - len(duplicates))
+    else:
+        duplicates = {p: [] for p in image_paths}
     
-    # Use a ThreadPoolExecutor to send multiple requests to Azure at the same time.
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_file = {executor.submit(analyze_document, img_path): img_path for img_path in image_paths}
-        
-        for future in as_completed(future_to_file):
-            result, filename = future.result()
+    # Drive all requests from one event loop; the semaphore bounds how many are in flight
+    # and the rate limiter keeps submissions under the per-second quota.
+    semaphore = asyncio.Semaphore(min(AZURE_MAX_CONCURRENCY, len(duplicates)))
+    rate_limiter = RateLimiter(AZURE_MAX_TPS)
+    async with _build_client() as client:
+        async def bounded_analyze(img_path):
+            async with semaphore:
+                return await analyze_document(client, img_path, rate_limiter)
+
+        results = await asyncio.gather(*(bounded_analyze(p) for p in duplicates))
+        for (result, filename), copies in zip(results, duplicates.values()):
             if result:
                 details = extract_and_validate_receipt(result)
-                details['source_file'] = os.path.basename(filename)
+                details.source_file = filename
                 all_results.append(details)
+                all_results.extend(replace(details, source_file=_display_name(p)) for p in copies)
+
+    apply_discounts(all_results)
+    validate_totals(all_results)
     return all_results
 
+def _json_default(obj):
+    """orjson fallback: expands item columns back into rows and stringifies stray SDK types."""
+    if isinstance(obj, ItemColumns):
+        return obj.rows()
+    return str(obj)
+
+def _csv_row(r: Receipt) -> tuple:
+    """
+    One summary CSV row, built from CSV_COLUMNS so values can never drift from the header.
+    Validation info columns are flattened in from `r.validation_info`; the rest are Receipt
+    attributes (a misspelled column raises AttributeError instead of shifting values).
+    """
+    v = r.validation_info
+    return tuple(
+        (getattr(v, col) if v else None) if col in _VALIDATION_COLUMNS else getattr(r, col)
+        for col in CSV_COLUMNS
+    )
+
 def save_results(results_list: list, base_filename="extraction_log"):
     """
     Saves the extracted data to both a detailed JSON file and a summary CSV file.
@@ -183,24 +514,20 @@ def save_results(results_list: list, base_filename="extraction_log"):
 
     # Save detailed JSON output
     json_filename = f"{base_filename}.json"
-    print(f"Saving detailed results to {json_filename}...")
-    with open(json_filename, 'w') as f:
-        json.dump(results_list, f, indent=2, default=str)
+    log.info("Saving detailed results to %s...", json_filename)
+    # orjson serializes the dataclasses natively; _json_default only sees item columns and stray types.
+    with open(json_filename, 'wb') as f:
+        f.write(orjson.dumps(results_list, default=_json_default, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
     
     # Save flattened summary to CSV
     csv_filename = f"{base_filename}.csv"
-    print(f"Saving summary to {csv_filename}...")
-    flat_results = []
-    for res in results_list:
-        flat_res = res.copy()
-        flat_res.pop('items', None) # Remove nested items list for CSV
-        validation_info = flat_res.pop('validation_info', {})
-        flat_res.update(validation_info)
-        flat_results.append(flat_res)
-        
-    df = pd.DataFrame(flat_results)
-    df.to_csv(csv_filename, mode='a', header=not os.path.exists(csv_filename), index=False)
-    print(f"\nAll files saved successfully.")
+    log.info("Saving summary to %s...", csv_filename)
+    # Flatten lazily into tuples; the fixed column list spares pandas a column inference pass.
+    df = pd.DataFrame.from_records((_csv_row(r) for r in results_list), columns=CSV_COLUMNS)
+    # Append to the running log; the header is only written when the file is new/empty.
+    with open(csv_filename, 'a', newline='') as f:
+        df.to_csv(f, header=f.tell() == 0, index=False)
+    log.info("\nAll files saved successfully.")
 
 
 if __name__ == "__main__":
@@ -209,14 +536,28 @@ if __name__ == "__main__":
         description="An advanced, industrial-grade receipt scanner using Azure AI.",
         epilog="Example usage: python scan.py -i ./receipts/"
     )
-    cli_parser.add_argument("-i", "--input", required=True, help="Path to a receipt image file or a directory.")
+    cli_parser.add_argument("-i", "--input", required=True, help="Path to a receipt image file or a directory, or an image URL.")
     args = cli_parser.parse_args()
 
+    # --- Logging Setup ---
+    # Records go through a queue and are written by a background listener thread,
+    # so logging never blocks the event loop on console I/O.
+    log_queue = queue.Queue()
+    logging.basicConfig(format="%(message)s", handlers=[logging.handlers.QueueHandler(log_queue)])
+    log.setLevel(logging.INFO) # Only this script logs at INFO; the Azure SDK's HTTP logging stays quiet.
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+
     # --- Main Pipeline Execution ---
-    if not AZURE_ENDPOINT or not AZURE_KEY:
-        print("ERROR: Please set the AZURE_ENDPOINT and AZURE_KEY environment variables first.")
-    else:
-        results = process_receipt_path_concurrently(args.input)
-        if results:
-            print("\n--- EXTRACTION COMPLETE ---")
-            save_results(results)
\ No newline at end of file
+    try:
+        if not AZURE_ENDPOINT or not AZURE_KEY:
+            log.error("ERROR: Please set the AZURE_ENDPOINT and AZURE_KEY environment variables first.")
+        elif AZURE_MAX_CONCURRENCY is None or AZURE_MAX_TPS is None:
+            log.error("ERROR: AZURE_MAX_CONCURRENCY and AZURE_MAX_TPS must be numbers of at least 1.")
+        else:
+            results = asyncio.run(process_receipt_path_concurrently(args.input))
+            if results:
+                log.info("\n--- EXTRACTION COMPLETE ---")
+                save_results(results)
+    finally:
+        listener.stop()
\ No newline at end of file